@@ -1,8 +1,85 @@
+import math
+
 import numba
 import numpy as np
-import quaternion
 
 
+@numba.njit(cache=True)
+def rotation_matrix_to_quaternion(Q: np.ndarray) -> np.ndarray:
+    r"""
+    Convert a rotation matrix to a quaternion :math:`(w, x, y, z)`,
+    branching on the largest of the trace and the diagonal entries
+    to keep the square root well conditioned.
+    """
+    trace = Q[0, 0] + Q[1, 1] + Q[2, 2]
+    if trace > 0:
+        s = 2.0 * math.sqrt(trace + 1.0)
+        w = 0.25 * s
+        x = (Q[2, 1] - Q[1, 2]) / s
+        y = (Q[0, 2] - Q[2, 0]) / s
+        z = (Q[1, 0] - Q[0, 1]) / s
+    elif Q[0, 0] > Q[1, 1] and Q[0, 0] > Q[2, 2]:
+        s = 2.0 * math.sqrt(1.0 + Q[0, 0] - Q[1, 1] - Q[2, 2])
+        w = (Q[2, 1] - Q[1, 2]) / s
+        x = 0.25 * s
+        y = (Q[0, 1] + Q[1, 0]) / s
+        z = (Q[0, 2] + Q[2, 0]) / s
+    elif Q[1, 1] > Q[2, 2]:
+        s = 2.0 * math.sqrt(1.0 + Q[1, 1] - Q[0, 0] - Q[2, 2])
+        w = (Q[0, 2] - Q[2, 0]) / s
+        x = (Q[0, 1] + Q[1, 0]) / s
+        y = 0.25 * s
+        z = (Q[1, 2] + Q[2, 1]) / s
+    else:
+        s = 2.0 * math.sqrt(1.0 + Q[2, 2] - Q[0, 0] - Q[1, 1])
+        w = (Q[1, 0] - Q[0, 1]) / s
+        x = (Q[0, 2] + Q[2, 0]) / s
+        y = (Q[1, 2] + Q[2, 1]) / s
+        z = 0.25 * s
+    return np.array([w, x, y, z])
+
+
+@numba.njit(cache=True)
+def quaternion_to_rotation_matrix(q: np.ndarray) -> np.ndarray:
+    r"""
+    Convert a quaternion :math:`(w, x, y, z)` to a rotation matrix.
+    The quaternion does not need to be normalized, since the
+    homogeneous form is divided by its squared norm.
+    """
+    w, x, y, z = q
+    ww, xx, yy, zz = w * w, x * x, y * y, z * z
+    return np.array(
+        [
+            [ww + xx - yy - zz, 2 * (x * y - z * w), 2 * (x * z + y * w)],
+            [2 * (x * y + z * w), ww - xx + yy - zz, 2 * (y * z - x * w)],
+            [2 * (x * z - y * w), 2 * (y * z + x * w), ww - xx - yy + zz],
+        ],
+    ) / (ww + xx + yy + zz)
+
+
+@numba.njit(cache=True)
+def slerp(qa: np.ndarray, qb: np.ndarray, t: float) -> np.ndarray:
+    r"""
+    Spherical linear interpolation between the quaternions
+    :math:`q_a` (at :math:`t = 0`) and :math:`q_b` (at :math:`t = 1`).
+    Falls back to a linear interpolation when the quaternions are
+    close, in which case the result is not normalized.
+    """
+    dot = qa.dot(qb)
+    if dot < 0:
+        # Take the shortest path
+        qb = -qb
+        dot = -dot
+    dot = min(dot, 1.0)
+    if dot > 0.9995:
+        return (1 - t) * qa + t * qb
+
+    theta = math.acos(dot)
+    sin_theta = math.sin(theta)
+    return (math.sin((1 - t) * theta) * qa + math.sin(t * theta) * qb) / sin_theta
+
+
+@numba.njit(cache=True)
 def bislerp(
     Qa: np.ndarray,
     Qb: np.ndarray,
@@ -13,49 +90,203 @@ def bislerp(
     Assiume that :math:`Q_a` and :math:`Q_b` refers to
     timepoint :math:`0` and :math:`1` respectively.
     Using spherical linear interpolation (slerp) find the
-    orthogonal matrix at timepoint :math:`t`.
+    orthogonal matrix at timepoint :math:`t`. This is the
+    reference implementation of :func:`bislerp_batched`.
     """
 
-    if ~Qa.any() and ~Qb.any():
+    if not Qa.any() and not Qb.any():
         return np.zeros((3, 3))
-    if ~Qa.any():
+    if not Qa.any():
         return Qb
-    if ~Qb.any():
+    if not Qb.any():
         return Qa
 
     tol = 1e-12
-    qa = quaternion.from_rotation_matrix(Qa)
-    qb = quaternion.from_rotation_matrix(Qb)
-
-    quat_i = quaternion.quaternion(0, 1, 0, 0)
-    quat_j = quaternion.quaternion(0, 0, 1, 0)
-    quat_k = quaternion.quaternion(0, 0, 0, 1)
-
-    quat_array = [
-        qa,
-        -qa,
-        quat_i * qa,
-        -quat_i * qa,
-        quat_j * qa,
-        -quat_j * qa,
-        quat_k * qa,
-        -quat_k * qa,
-    ]
+    qa = rotation_matrix_to_quaternion(Qa)
+    qb = rotation_matrix_to_quaternion(Qb)
 
-    dot_arr = [np.linalg.norm((qm * qb).components) for qm in quat_array]
-    max_idx = int(np.argmax(dot_arr))
+    # If qa and qb already describe the same rotation (up to sign)
+    # there is nothing to interpolate and the other candidates
+    # need not be built
+    if abs(qa.dot(qb)) > 1 - tol:
+        return Qb
+
+    # Candidates qa, qa * i, qa * j and qa * k, i.e. Qa with the
+    # sign of two of its axes flipped, which describe the same
+    # coordinate system. Their negations are accounted for by the
+    # sign of the dot product.
+    w, x, y, z = qa
+    quat_array = np.array(
+        [
+            [w, x, y, z],
+            [-x, w, z, -y],
+            [-y, -z, w, x],
+            [-z, y, -x, w],
+        ],
+    )
+
+    dot_arr = (quat_array * qb).sum(axis=1)
+    max_idx = int(np.argmax(np.abs(dot_arr)))
     max_dot = dot_arr[max_idx]
     qm = quat_array[max_idx]
+    if max_dot < 0:
+        qm = -qm
+        max_dot = -max_dot
 
     if max_dot > 1 - tol:
         return Qb
 
-    qm_slerp = quaternion.slerp(qm, qb, 0, 1, t)
-    qm_norm = qm_slerp.normalized()
-    Qab = quaternion.as_rotation_matrix(qm_norm)
+    return quaternion_to_rotation_matrix(slerp(qm, qb, t))
+
+
+def rotation_matrix_to_quaternion_batched(Q: np.ndarray) -> np.ndarray:
+    r"""
+    Batched version of :func:`rotation_matrix_to_quaternion`, where
+    :math:`Q` has shape ``(N, 3, 3)``. The quaternions are returned
+    as an array of shape ``(4, N)`` with rows :math:`w, x, y, z`.
+    """
+    Q00, Q01, Q02 = Q[:, 0, 0], Q[:, 0, 1], Q[:, 0, 2]
+    Q10, Q11, Q12 = Q[:, 1, 0], Q[:, 1, 1], Q[:, 1, 2]
+    Q20, Q21, Q22 = Q[:, 2, 0], Q[:, 2, 1], Q[:, 2, 2]
+    trace = Q00 + Q11 + Q22
+
+    branch = np.where(
+        trace > 0,
+        0,
+        np.where((Q00 > Q11) & (Q00 > Q22), 1, np.where(Q11 > Q22, 2, 3)),
+    )
+    q = np.zeros((4, len(Q)))
+
+    m = branch == 0
+    s = 2.0 * np.sqrt(trace[m] + 1.0)
+    q[:, m] = [
+        0.25 * s,
+        (Q21[m] - Q12[m]) / s,
+        (Q02[m] - Q20[m]) / s,
+        (Q10[m] - Q01[m]) / s,
+    ]
+
+    m = branch == 1
+    s = 2.0 * np.sqrt(1.0 + Q00[m] - Q11[m] - Q22[m])
+    q[:, m] = [
+        (Q21[m] - Q12[m]) / s,
+        0.25 * s,
+        (Q01[m] + Q10[m]) / s,
+        (Q02[m] + Q20[m]) / s,
+    ]
+
+    m = branch == 2
+    s = 2.0 * np.sqrt(1.0 + Q11[m] - Q00[m] - Q22[m])
+    q[:, m] = [
+        (Q02[m] - Q20[m]) / s,
+        (Q01[m] + Q10[m]) / s,
+        0.25 * s,
+        (Q12[m] + Q21[m]) / s,
+    ]
+
+    m = branch == 3
+    s = 2.0 * np.sqrt(1.0 + Q22[m] - Q00[m] - Q11[m])
+    q[:, m] = [
+        (Q10[m] - Q01[m]) / s,
+        (Q02[m] + Q20[m]) / s,
+        (Q12[m] + Q21[m]) / s,
+        0.25 * s,
+    ]
+    return q
+
+
+def quaternion_to_rotation_matrix_batched(q: np.ndarray) -> np.ndarray:
+    r"""
+    Batched version of :func:`quaternion_to_rotation_matrix`, where
+    :math:`q` has shape ``(4, N)``. Returns an array of shape ``(N, 3, 3)``.
+    """
+    w, x, y, z = q
+    ww, xx, yy, zz = w * w, x * x, y * y, z * z
+    R = np.stack(
+        [
+            np.stack([ww + xx - yy - zz, 2 * (x * y - z * w), 2 * (x * z + y * w)], -1),
+            np.stack([2 * (x * y + z * w), ww - xx + yy - zz, 2 * (y * z - x * w)], -1),
+            np.stack([2 * (x * z - y * w), 2 * (y * z + x * w), ww - xx - yy + zz], -1),
+        ],
+        axis=1,
+    )
+    return R / (ww + xx + yy + zz)[:, np.newaxis, np.newaxis]
+
+
+def slerp_batched(qa: np.ndarray, qb: np.ndarray, t: np.ndarray) -> np.ndarray:
+    r"""
+    Batched version of :func:`slerp`, where the quaternions
+    have shape ``(4, N)`` and :math:`t` has shape ``(N,)``.
+    """
+    dot = (qa * qb).sum(axis=0)
+    # Take the shortest path
+    sign = np.where(dot < 0, -1.0, 1.0)
+    qb = sign * qb
+    dot = np.minimum(sign * dot, 1.0)
+
+    lerp = dot > 0.9995
+    theta = np.arccos(dot)
+    sin_theta = np.where(lerp, 1.0, np.sin(theta))
+    wa = np.where(lerp, 1 - t, np.sin((1 - t) * theta) / sin_theta)
+    wb = np.where(lerp, t, np.sin(t * theta) / sin_theta)
+    return wa * qa + wb * qb
+
+
+def bislerp_batched(
+    Qa: np.ndarray,
+    Qb: np.ndarray,
+    t: np.ndarray,
+) -> np.ndarray:
+    r"""
+    Batched version of :func:`bislerp`, where :math:`Q_a` and
+    :math:`Q_b` have shape ``(N, 3, 3)`` and :math:`t` has shape ``(N,)``.
+    """
+    zero_a = ~Qa.any(axis=(1, 2))
+    zero_b = ~Qb.any(axis=(1, 2))
+    # Qb where it is non-zero, otherwise Qa (which may also be zero)
+    Qab = np.where(zero_b[:, np.newaxis, np.newaxis], Qa, Qb)
+
+    idx = np.flatnonzero(~zero_a & ~zero_b)
+    if len(idx) == 0:
+        return Qab
+
+    tol = 1e-12
+    qa = rotation_matrix_to_quaternion_batched(Qa[idx])
+    qb = rotation_matrix_to_quaternion_batched(Qb[idx])
+
+    # Rows where qa and qb already describe the same rotation (up to
+    # sign) keep Qb, only the remaining rows need the other candidates
+    m = ~(np.abs((qa * qb).sum(axis=0)) > 1 - tol)
+    if not m.any():
+        return Qab
+    idx, qa, qb = idx[m], qa[:, m], qb[:, m]
+
+    # Candidates qa, qa * i, qa * j and qa * k
+    w, x, y, z = qa
+    quat_array = np.array(
+        [
+            [w, x, y, z],
+            [-x, w, z, -y],
+            [-y, -z, w, x],
+            [-z, y, -x, w],
+        ],
+    )
+    dot_arr = (quat_array * qb).sum(axis=1)
+    max_idx = np.argmax(np.abs(dot_arr), axis=0)
+    max_dot = dot_arr[max_idx, np.arange(len(idx))]
+    sign = np.where(max_dot < 0, -1.0, 1.0)
+
+    # Rows where |max_dot| > 1 - tol keep Qb
+    m = ~(sign * max_dot > 1 - tol)
+    if m.any():
+        qm = sign[m] * quat_array[max_idx[m], :, np.flatnonzero(m)].T
+        Qab[idx[m]] = quaternion_to_rotation_matrix_batched(
+            slerp_batched(qm, qb[:, m], t[idx[m]]),
+        )
     return Qab
 
 
+@numba.njit(cache=True)
 def system_at_dof(
     lv: float,
     rv: float,
@@ -72,7 +303,9 @@ def system_at_dof(
 ) -> np.ndarray:
     """
     Compte the fiber, sheet and sheet normal at a
-    single degre of freedom
+    single degre of freedom. This is the reference
+    implementation of :func:`system_at_dofs`, which is the one
+    used by :func:`ldrb.ldrb.compute_fiber_sheet_system`.
 
     Arguments
     ---------
@@ -109,9 +342,11 @@ def system_at_dof(
     else:
         depth = rv / (lv + rv)
 
-    alpha_s = alpha_endo * (1 - depth) - alpha_endo * depth
+    # alpha_endo * (1 - depth) - alpha_endo * depth, and similarly for beta
+    septum_weight = 1 - 2 * depth
+    alpha_s = alpha_endo * septum_weight
     alpha_w = alpha_endo * (1 - epi) + alpha_epi * epi
-    beta_s = beta_endo * (1 - depth) - beta_endo * depth
+    beta_s = beta_endo * septum_weight
     beta_w = beta_endo * (1 - epi) + beta_epi * epi
 
     Q_lv = np.zeros((3, 3))
@@ -135,7 +370,7 @@ def system_at_dof(
     return Q_fiber
 
 
-@numba.njit
+@numba.njit(cache=True)
 def normalize(u: np.ndarray) -> np.ndarray:
     """
     Normalize vector
@@ -143,7 +378,7 @@ def normalize(u: np.ndarray) -> np.ndarray:
     return u / np.linalg.norm(u)
 
 
-@numba.njit
+@numba.njit(cache=True)
 def axis(u: np.ndarray, v: np.ndarray) -> np.ndarray:
     r"""
     Construct the fiber orientation coordinate system.
@@ -156,13 +391,9 @@ def axis(u: np.ndarray, v: np.ndarray) -> np.ndarray:
 
     e1 = normalize(u)
 
-    # Create an initial guess for e0
-    e2 = normalize(v)
-    e2 -= e1.dot(e2) * e1
-    e2 = normalize(e2)
-
+    # Gram-Schmidt: e1 and e2 are orthonormal so e0 is already a unit vector
+    e2 = normalize(v - e1.dot(v) * e1)
     e0 = np.cross(e1, e2)
-    e0 = normalize(e0)
 
     Q = np.zeros((3, 3))
     Q[:, 0] = e0
@@ -172,7 +403,7 @@ def axis(u: np.ndarray, v: np.ndarray) -> np.ndarray:
     return Q
 
 
-@numba.njit
+@numba.njit(cache=True)
 def orient(Q: np.ndarray, alpha: float, beta: float) -> np.ndarray:
     r"""
     Define the orthotropic fiber orientations.
@@ -182,27 +413,124 @@ def orient(Q: np.ndarray, alpha: float, beta: float) -> np.ndarray:
     and sheet-normal axis determine by the angles :math:`\alpha`
     (fiber) and :math:`\beta` (sheets).
     """
-    A = np.zeros((3, 3))
-    A[0, :] = [np.cos(np.radians(alpha)), -np.sin(np.radians(alpha)), 0]
-    A[1, :] = [np.sin(np.radians(alpha)), np.cos(np.radians(alpha)), 0]
-    A[2, :] = [0, 0, 1]
+    ca = math.cos(math.radians(alpha))
+    sa = math.sin(math.radians(alpha))
+    cb = math.cos(math.radians(beta))
+    sb = math.sin(math.radians(beta))
+
+    # The product of the rotation about e2 by alpha and about e0 by beta
+    AB = np.array(
+        [
+            [ca, -sa * cb, -sa * sb],
+            [sa, ca * cb, ca * sb],
+            [0.0, -sb, cb],
+        ],
+    )
+    return np.dot(Q, AB)
+
+
+def system_at_dofs(
+    lv: np.ndarray,
+    rv: np.ndarray,
+    epi: np.ndarray,
+    grad_lv: np.ndarray,
+    grad_rv: np.ndarray,
+    grad_epi: np.ndarray,
+    grad_ab: np.ndarray,
+    alpha_endo: np.ndarray,
+    alpha_epi: np.ndarray,
+    beta_endo: np.ndarray,
+    beta_epi: np.ndarray,
+    tol: float = 1e-7,
+) -> np.ndarray:
+    """
+    Compute the fiber, sheet and sheet normal at all
+    degrees of freedom at once. This is the batched version
+    of :func:`system_at_dof`, where the scalars and angles
+    have shape ``(N,)`` and the gradients have shape ``(N, 3)``.
+    Returns an array of shape ``(N, 3, 3)``.
+    """
+    depth = np.divide(rv, lv + rv, out=np.full(lv.shape, 0.5), where=lv + rv >= tol)
+
+    # alpha_endo * (1 - depth) - alpha_endo * depth, and similarly for beta
+    septum_weight = 1 - 2 * depth
+    alpha_s = alpha_endo * septum_weight
+    alpha_w = alpha_endo * (1 - epi) + alpha_epi * epi
+    beta_s = beta_endo * septum_weight
+    beta_w = beta_endo * (1 - epi) + beta_epi * epi
+
+    n = len(lv)
+
+    Q_lv = np.zeros((n, 3, 3))
+    mask = lv > tol
+    Q_lv[mask] = orient_batched(
+        axis_batched(grad_ab[mask], -1 * grad_lv[mask]),
+        alpha_s[mask],
+        beta_s[mask],
+    )
+
+    Q_rv = np.zeros((n, 3, 3))
+    mask = rv > tol
+    Q_rv[mask] = orient_batched(
+        axis_batched(grad_ab[mask], grad_rv[mask]),
+        alpha_s[mask],
+        beta_s[mask],
+    )
+
+    Q_epi = np.zeros((n, 3, 3))
+    mask = epi > tol
+    Q_epi[mask] = orient_batched(
+        axis_batched(grad_ab[mask], grad_epi[mask]),
+        alpha_w[mask],
+        beta_w[mask],
+    )
+
+    Q_endo = bislerp_batched(Q_lv, Q_rv, depth)
+    Q_fiber = bislerp_batched(Q_endo, Q_epi, epi)
+    return Q_fiber
+
+
+def _normalize_batched(u: np.ndarray) -> np.ndarray:
+    return u / np.linalg.norm(u, axis=-1)[:, np.newaxis]
+
+
+def axis_batched(u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    r"""
+    Batched version of :func:`axis`, where :math:`u` and
+    :math:`v` have shape ``(N, 3)``. Returns an array of
+    shape ``(N, 3, 3)``.
+    """
+    e1 = _normalize_batched(u)
+    e2 = _normalize_batched(v - np.einsum("ni,ni->n", e1, v)[:, np.newaxis] * e1)
+    e0 = np.cross(e1, e2)
+
+    return np.stack([e0, e1, e2], axis=-1)
 
-    B = np.zeros((3, 3))
-    B[0, :] = [1, 0, 0]
-    B[1, :] = [0, np.cos(np.radians(beta)), np.sin(np.radians(beta))]
-    B[2, :] = [0, -np.sin(np.radians(beta)), np.cos(np.radians(beta))]
 
-    C = np.dot(Q.real, A).dot(B)
-    return C
+def orient_batched(Q: np.ndarray, alpha: np.ndarray, beta: np.ndarray) -> np.ndarray:
+    r"""
+    Batched version of :func:`orient`, where :math:`Q` has
+    shape ``(N, 3, 3)`` and the angles have shape ``(N,)``.
+    """
+    ca = np.cos(np.radians(alpha))
+    sa = np.sin(np.radians(alpha))
+    cb = np.cos(np.radians(beta))
+    sb = np.sin(np.radians(beta))
+
+    AB = np.stack(
+        [
+            np.stack([ca, -sa * cb, -sa * sb], axis=-1),
+            np.stack([sa, ca * cb, ca * sb], axis=-1),
+            np.stack([np.zeros_like(sb), -sb, cb], axis=-1),
+        ],
+        axis=1,
+    )
+    return np.matmul(Q, AB)
 
 
 def _compute_fiber_sheet_system(
-    f0,
-    s0,
-    n0,
-    xdofs,
-    ydofs,
-    zdofs,
+    fiber_system,
+    vdofs,
     sdofs,
     lv_scalar,
     rv_scalar,
@@ -227,97 +555,60 @@ def _compute_fiber_sheet_system(
     beta_epi_sept,
     tol,
 ):
-    grad_lv = np.zeros(3)
-    grad_rv = np.zeros(3)
-    grad_epi = np.zeros(3)
-    grad_ab = np.zeros(3)
-
-    for i in range(len(xdofs)):
-
-        lv = lv_scalar[sdofs[i]]
-        rv = rv_scalar[sdofs[i]]
-        epi = epi_scalar[sdofs[i]]
-        lv_rv = lv_rv_scalar[sdofs[i]]
-
-        grad_lv[0] = lv_gradient[xdofs[i]]
-        grad_lv[1] = lv_gradient[ydofs[i]]
-        grad_lv[2] = lv_gradient[zdofs[i]]
-
-        grad_rv[0] = rv_gradient[xdofs[i]]
-        grad_rv[1] = rv_gradient[ydofs[i]]
-        grad_rv[2] = rv_gradient[zdofs[i]]
-
-        grad_epi[0] = epi_gradient[xdofs[i]]
-        grad_epi[1] = epi_gradient[ydofs[i]]
-        grad_epi[2] = epi_gradient[zdofs[i]]
-
-        grad_ab[0] = apex_gradient[xdofs[i]]
-        grad_ab[1] = apex_gradient[ydofs[i]]
-        grad_ab[2] = apex_gradient[zdofs[i]]
-
-        if epi > 0.5:
-            if lv_rv >= 0.5:
-                # We are in the LV region
-                marker_scalar[sdofs[i]] = 1
-                alpha_endo = alpha_endo_lv
-                beta_endo = beta_endo_lv
-                alpha_epi = alpha_epi_lv
-                beta_epi = beta_epi_lv
-            else:
-                # We are in the RV region
-                marker_scalar[sdofs[i]] = 2
-                alpha_endo = alpha_endo_rv
-                beta_endo = beta_endo_rv
-                alpha_epi = alpha_epi_rv
-                beta_epi = beta_epi_rv
-        else:
-            if lv_rv >= 1 - tol:
-                # We are in the LV region
-                marker_scalar[sdofs[i]] = 1
-                alpha_endo = alpha_endo_lv
-                beta_endo = beta_endo_lv
-                alpha_epi = alpha_epi_lv
-                beta_epi = beta_epi_lv
-            elif lv_rv <= tol:
-                # We are in the RV region
-                marker_scalar[sdofs[i]] = 2
-                alpha_endo = alpha_endo_rv
-                beta_endo = beta_endo_rv
-                alpha_epi = alpha_epi_rv
-                beta_epi = beta_epi_rv
-            else:
-                # We are in the septum
-                marker_scalar[sdofs[i]] = 3
-                alpha_endo = alpha_endo_sept
-                beta_endo = beta_endo_sept
-                alpha_epi = alpha_epi_sept
-                beta_epi = beta_epi_sept
-
-        Q_fiber = system_at_dof(
-            lv=lv,
-            rv=rv,
-            epi=epi,
-            grad_lv=grad_lv,
-            grad_rv=grad_rv,
-            grad_epi=grad_epi,
-            grad_ab=grad_ab,
-            alpha_endo=alpha_endo,
-            alpha_epi=alpha_epi,
-            beta_endo=beta_endo,
-            beta_epi=beta_epi,
-            tol=tol,
-        )
-        if Q_fiber is None:
-            continue
-
-        f0[xdofs[i]] = Q_fiber[0, 0]
-        f0[ydofs[i]] = Q_fiber[1, 0]
-        f0[zdofs[i]] = Q_fiber[2, 0]
-
-        s0[xdofs[i]] = Q_fiber[0, 1]
-        s0[ydofs[i]] = Q_fiber[1, 1]
-        s0[zdofs[i]] = Q_fiber[2, 1]
-
-        n0[xdofs[i]] = Q_fiber[0, 2]
-        n0[ydofs[i]] = Q_fiber[1, 2]
-        n0[zdofs[i]] = Q_fiber[2, 2]
+    if vdofs is None:
+        # Standard layout with x, y and z interleaved, so the vector
+        # arrays can be viewed as (N, 3) arrays instead of gathered
+        vdofs = sdofs = slice(None)
+        lv_gradient = lv_gradient.reshape(-1, 3)
+        rv_gradient = rv_gradient.reshape(-1, 3)
+        epi_gradient = epi_gradient.reshape(-1, 3)
+        apex_gradient = apex_gradient.reshape(-1, 3)
+        fiber_system = fiber_system.reshape(3, -1, 3)
+
+    lv = lv_scalar[sdofs]
+    rv = rv_scalar[sdofs]
+    epi = epi_scalar[sdofs]
+    lv_rv = lv_rv_scalar[sdofs]
+
+    grad_lv = lv_gradient[vdofs]
+    grad_rv = rv_gradient[vdofs]
+    grad_epi = epi_gradient[vdofs]
+    grad_ab = apex_gradient[vdofs]
+
+    # Outside the septum (epi > 0.5) we split between the LV and
+    # RV at lv_rv = 0.5, otherwise everything in between is septum
+    mask_lv = np.where(epi > 0.5, lv_rv >= 0.5, lv_rv >= 1 - tol)
+    mask_rv = ~mask_lv & ((epi > 0.5) | (lv_rv <= tol))
+
+    # Region codes 1 (LV), 2 (RV) and 3 (septum) index rows in the angle table
+    region = np.where(mask_lv, 1, np.where(mask_rv, 2, 3))
+    marker_scalar[sdofs] = region
+
+    angles = np.array(
+        [
+            [alpha_endo_lv, alpha_epi_lv, beta_endo_lv, beta_epi_lv],
+            [alpha_endo_rv, alpha_epi_rv, beta_endo_rv, beta_epi_rv],
+            [alpha_endo_sept, alpha_epi_sept, beta_endo_sept, beta_epi_sept],
+        ],
+        dtype=float,
+    )
+    alpha_endo, alpha_epi, beta_endo, beta_epi = angles[region - 1].T
+
+    Q_fiber = system_at_dofs(
+        lv=lv,
+        rv=rv,
+        epi=epi,
+        grad_lv=grad_lv,
+        grad_rv=grad_rv,
+        grad_epi=grad_epi,
+        grad_ab=grad_ab,
+        alpha_endo=alpha_endo,
+        alpha_epi=alpha_epi,
+        beta_endo=beta_endo,
+        beta_epi=beta_epi,
+        tol=tol,
+    )
+
+    # Fiber, sheet and sheet normal are the columns of Q_fiber, and they
+    # are written to the rows of fiber_system in one go
+    fiber_system[:, vdofs] = Q_fiber.transpose(2, 0, 1)
@@ -4,6 +4,7 @@ from typing import Dict
 from typing import List
 from typing import Optional
 from typing import Tuple
+from typing import Union
 
 import dolfin as df
 import numpy as np
@@ -12,6 +13,8 @@ from dolfin.mesh.meshfunction import MeshFunction
 from . import utils
 
 FiberSheetSystem = namedtuple("FiberSheetSystem", "fiber, sheet, sheet_normal")
+Dofs = namedtuple("Dofs", "vector, scalar")
+LinearSolver = Union[df.LUSolver, df.KrylovSolver, df.PETScKrylovSolver]
 
 
 def laplace(
@@ -56,25 +59,13 @@ def laplace(
     return data
 
 
-def standard_dofs(n: int) -> np.ndarray:
-    """
-    Get the standard list of dofs for a given length
-    """
-
-    x_dofs = np.arange(0, 3 * n, 3)
-    y_dofs = np.arange(1, 3 * n, 3)
-    z_dofs = np.arange(2, 3 * n, 3)
-    scalar_dofs = np.arange(0, n)
-    return np.stack([x_dofs, y_dofs, z_dofs, scalar_dofs], -1)
-
-
 def compute_fiber_sheet_system(
     lv_scalar: np.ndarray,
     lv_gradient: np.ndarray,
     epi_scalar: np.ndarray,
     epi_gradient: np.ndarray,
     apex_gradient: np.ndarray,
-    dofs: Optional[np.ndarray] = None,
+    dofs: Optional[Dofs] = None,
     rv_scalar: Optional[np.ndarray] = None,
     rv_gradient: Optional[np.ndarray] = None,
     lv_rv_scalar: Optional[np.ndarray] = None,
@@ -94,9 +85,11 @@ def compute_fiber_sheet_system(
 ) -> FiberSheetSystem:
     """
     Compute the fiber-sheets system on all degrees of freedom.
+    If `dofs` is not provided, the scalars are assumed to be
+    stored in dof order and the gradients with the x, y and z
+    components of each dof interleaved, i.e. component ``k`` of
+    dof ``i`` is found at index ``3 * i + k``.
     """
-    if dofs is None:
-        dofs = standard_dofs(len(lv_scalar))
     if rv_scalar is None:
         rv_scalar = np.zeros_like(lv_scalar)
     if lv_rv_scalar is None:
@@ -155,9 +148,8 @@ def compute_fiber_sheet_system(
         ),
     )
 
-    f0 = np.zeros_like(lv_gradient)
-    s0 = np.zeros_like(lv_gradient)
-    n0 = np.zeros_like(lv_gradient)
+    # Fiber, sheet and sheet normal share one buffer
+    fiber_system = np.zeros((3,) + lv_gradient.shape)
     if marker_scalar is None:
         marker_scalar = np.zeros_like(lv_scalar)
 
@@ -166,13 +158,9 @@ def compute_fiber_sheet_system(
     from .calculus import _compute_fiber_sheet_system
 
     _compute_fiber_sheet_system(
-        f0,
-        s0,
-        n0,
-        dofs[:, 0],
-        dofs[:, 1],
-        dofs[:, 2],
-        dofs[:, 3],
+        fiber_system,
+        None if dofs is None else dofs.vector,
+        None if dofs is None else dofs.scalar,
         lv_scalar,
         rv_scalar,
         epi_scalar,
@@ -197,10 +185,11 @@ def compute_fiber_sheet_system(
         tol,
     )
 
+    f0, s0, n0 = fiber_system
     return FiberSheetSystem(fiber=f0, sheet=s0, sheet_normal=n0)
 
 
-def dofs_from_function_space(mesh: df.Mesh, fiber_space: str) -> np.ndarray:
+def dofs_from_function_space(mesh: df.Mesh, fiber_space: str) -> Dofs:
     """
     Get the dofs from a function spaces define in the
     fiber_space string.
@@ -214,15 +203,17 @@ def dofs_from_function_space(mesh: df.Mesh, fiber_space: str) -> np.ndarray:
     y_dofs = np.arange(1, end - start, dim)
     z_dofs = np.arange(2, end - start, dim)
 
-    start, end = V.dofmap().ownership_range()
-    scalar_dofs = [
-        dof
-        for dof in range(end - start)
-        if V.dofmap().local_to_global_index(dof)
-        not in V.dofmap().local_to_global_unowned()
-    ]
+    dofmap = V.dofmap()
+    start, end = dofmap.ownership_range()
+    global_dofs = np.array(
+        [dofmap.local_to_global_index(dof) for dof in range(end - start)],
+        dtype=np.int64,
+    )
+    # Fetch the unowned dofs once rather than once per dof
+    unowned = np.asarray(dofmap.local_to_global_unowned(), dtype=np.int64)
+    scalar_dofs = np.flatnonzero(~np.isin(global_dofs, unowned))
 
-    return np.stack([x_dofs, y_dofs, z_dofs, scalar_dofs], -1)
+    return Dofs(vector=np.stack([x_dofs, y_dofs, z_dofs], -1), scalar=scalar_dofs)
 
 
 def dolfin_ldrb(
@@ -403,22 +394,16 @@ def fiber_system_to_dolfin(
     """
     Vv = utils.space_from_string(fiber_space, mesh, dim=3)
 
-    f0 = df.Function(Vv)
-    f0.vector().set_local(system.fiber)
-    f0.vector().apply("insert")
-    f0.rename("fiber", "fibers")
+    functions = FiberSheetSystem(*(df.Function(Vv) for _ in range(3)))
+    for name, f, values in zip(FiberSheetSystem._fields, functions, system):
+        f.vector().set_local(values)
+        f.rename(name, "fibers")
 
-    s0 = df.Function(Vv)
-    s0.vector().set_local(system.sheet)
-    s0.vector().apply("insert")
-    s0.rename("sheet", "fibers")
+    # Do the ghost updates after all local values are set
+    for f in functions:
+        f.vector().apply("insert")
 
-    n0 = df.Function(Vv)
-    n0.vector().set_local(system.sheet_normal)
-    n0.vector().apply("insert")
-    n0.rename("sheet_normal", "fibers")
-
-    return FiberSheetSystem(fiber=f0, sheet=s0, sheet_normal=n0)
+    return functions
 
 
 def apex_to_base(
@@ -475,13 +460,17 @@ def apex_to_base(
 
     base_bc = df.DirichletBC(V, 1, ffun, base_marker, "topological")
 
-    # Solver options
+    # Solver options. Check for AMG up front instead of
+    # relying on a failing solve to fall back
+    preconditioner = "default"
+    if df.has_krylov_solver_preconditioner("amg"):
+        preconditioner = "amg"
     solver = solve_system(
         a,
         L,
         base_bc,
         apex,
-        solver_parameters={"linear_solver": "cg", "preconditioner": "amg"},
+        solver_parameters={"linear_solver": "cg", "preconditioner": preconditioner},
         use_krylov_solver=use_krylov_solver,
         krylov_solver_atol=krylov_solver_atol,
         krylov_solver_rtol=krylov_solver_rtol,
@@ -520,28 +509,29 @@ def apex_to_base(
 
     # Solve the poisson equation
     bcs = [base_bc, apex_bc]
-    if solver is not None:
-        # Reuse existing solver
-        A, b = df.assemble_system(a, L, bcs)
-        solver.set_operator(A)
-        solver.solve(apex.vector(), b)
-    else:
-        solve_system(
-            a,
-            L,
-            bcs,
-            apex,
-            use_krylov_solver=use_krylov_solver,
-            krylov_solver_atol=krylov_solver_atol,
-            krylov_solver_rtol=krylov_solver_rtol,
-            krylov_solver_max_its=krylov_solver_max_its,
-            solver_parameters={"linear_solver": "gmres"},
-            verbose=verbose,
-        )
+    # Reuse existing solver
+    A, b = df.assemble_system(a, L, bcs)
+    solver.set_operator(A)
+    solver.solve(apex.vector(), b)
 
     return apex
 
 
+def same_element(V: df.FunctionSpace, W: df.FunctionSpace) -> bool:
+    """
+    Check if two function spaces on the same mesh have
+    the same family, degree and value shape, i.e that
+    interpolating between them is the identity.
+    """
+    e_V = V.ufl_element()
+    e_W = W.ufl_element()
+    return (
+        e_V.family() == e_W.family()
+        and e_V.degree() == e_W.degree()
+        and e_V.value_shape() == e_W.value_shape()
+    )
+
+
 def project_gradients(
     mesh: df.Mesh,
     scalar_solutions: Dict[str, df.Function],
@@ -566,13 +556,32 @@ def project_gradients(
 
     data = {}
     V_cg = df.FunctionSpace(mesh, df.VectorElement("Lagrange", mesh.ufl_cell(), 1))
+
+    # The mass matrix is the same for all the projections, so we
+    # assemble it and set up the solver once and only assemble the rhs
+    u = df.TrialFunction(V_cg)
+    v = df.TestFunction(V_cg)
+    A = df.assemble(df.inner(u, v) * df.dx)
+    solver = df.KrylovSolver("cg", "default")
+    solver.set_operator(A)
+
+    # With the default fiber space (CG_1) the interpolations are identities
+    interpolate_gradient = not same_element(Vv, V_cg)
+
     for case, scalar_solution in scalar_solutions.items():
 
-        scalar_solution_int = df.interpolate(scalar_solution, V)
+        if same_element(V, scalar_solution.function_space()):
+            scalar_solution_int = scalar_solution
+        else:
+            scalar_solution_int = df.interpolate(scalar_solution, V)
 
         if case != "lv_rv":
-            gradient_cg = df.project(df.grad(scalar_solution), V_cg, solver_type="cg")
-            gradient = df.interpolate(gradient_cg, Vv)
+            gradient_cg = df.Function(V_cg)
+            b = df.assemble(df.inner(df.grad(scalar_solution), v) * df.dx)
+            solver.solve(gradient_cg.vector(), b)
+            gradient = gradient_cg
+            if interpolate_gradient:
+                gradient = df.interpolate(gradient_cg, Vv)
 
             # Add gradient data
             data[case + "_gradient"] = gradient.vector().get_local()
@@ -767,7 +776,7 @@ def bayer(
     solutions = dict((what, df.Function(V)) for what in cases)
     solutions["apex"] = apex
     sol = solutions["apex"].vector().copy()
-    sol[:] = 0.0
+    sol.zero()
 
     # Iterate over the three different cases
     df.info("Solving Laplace equation")
@@ -775,6 +784,11 @@ def bayer(
     if "superlu_dist" in df.linear_solver_methods():
         solver_parameters = {"linear_solver": "superlu_dist"}
 
+    # All cases impose Dirichlet conditions on the same facets and only
+    # differ in the boundary values, so the operator (and its factorization
+    # or preconditioner) is reused and only the right hand side is assembled
+    solver = None
+    bc_dofs = None
     for case in cases:
         df.info(
             " {0} = 1, {1} = 0".format(
@@ -794,18 +808,28 @@ def bayer(
             for what in cases
         ]
 
-        solve_system(
-            a,
-            L,
-            bcs,
-            solutions[case],
-            solver_parameters=solver_parameters,
-            use_krylov_solver=use_krylov_solver,
-            krylov_solver_atol=krylov_solver_atol,
-            krylov_solver_rtol=krylov_solver_rtol,
-            krylov_solver_max_its=krylov_solver_max_its,
-            verbose=verbose,
-        )
+        dofs = set().union(*(bc.get_boundary_values() for bc in bcs))
+        if solver is not None:
+            if dofs != bc_dofs:
+                raise RuntimeError(
+                    "Dirichlet conditions for case {} are not imposed on "
+                    "the same dofs as for the first case".format(case),
+                )
+            solve_rhs(solver, a, L, bcs, solutions[case])
+        else:
+            bc_dofs = dofs
+            solver = solve_system(
+                a,
+                L,
+                bcs,
+                solutions[case],
+                solver_parameters=solver_parameters,
+                use_krylov_solver=use_krylov_solver,
+                krylov_solver_atol=krylov_solver_atol,
+                krylov_solver_rtol=krylov_solver_rtol,
+                krylov_solver_max_its=krylov_solver_max_its,
+                verbose=verbose,
+            )
 
         sol += solutions[case].vector()
 
@@ -843,7 +867,8 @@ def bayer(
             verbose=verbose,
         )
 
-    if not np.all(sol[:] > 0.999):
+    # Vector.min is reduced over all processes
+    if not sol.min() > 0.999:
         msg = "Solution does not always sum to one."
         if strict:
             raise RuntimeError(msg)
@@ -885,7 +910,8 @@ def solve_krylov(
     if ksp_view:
         df.PETScOptions.set("ksp_view")
     df.PETScOptions.set("pc_type", pc_type)
-    df.PETScOptions.set("pc_hypre_type", pc_hypre_type)
+    if pc_type == "hypre":
+        df.PETScOptions.set("pc_hypre_type", pc_hypre_type)
     if pc_view:
         df.PETScOptions.set("pc_view")
     solver.set_from_options()
@@ -897,10 +923,34 @@ def solve_krylov(
     return solver
 
 
-def solve_regular(a, L, bcs, u, solver_parameters):
+def solve_regular(a, L, bcs, u, solver_parameters) -> LinearSolver:
     if solver_parameters is None:
         solver_parameters = {"linear_solver": "gmres"}
-    df.solve(a == L, u, bcs, solver_parameters=solver_parameters)
+    method = solver_parameters["linear_solver"]
+    if method in df.lu_solver_methods():
+        solver = df.LUSolver(method)
+    else:
+        solver = df.KrylovSolver(
+            method,
+            solver_parameters.get("preconditioner", "default"),
+        )
+
+    A, b = df.assemble_system(a, L, bcs)
+    solver.set_operator(A)
+    solver.solve(u.vector(), b)
+    return solver
+
+
+def solve_rhs(solver: LinearSolver, a, L, bcs, u: df.Function) -> None:
+    """
+    Solve a system whose operator is already set on the solver,
+    so that only the right hand side needs to be assembled.
+    The boundary conditions must be imposed on the same dofs
+    as when the operator was assembled.
+    """
+    b = df.Vector(u.function_space().mesh().mpi_comm())
+    df.SystemAssembler(a, L, bcs).assemble(b)
+    solver.solve(u.vector(), b)
 
 
 def solve_system(
@@ -914,8 +964,12 @@ def solve_system(
     krylov_solver_rtol: Optional[float] = None,
     krylov_solver_max_its: Optional[int] = None,
     verbose: bool = False,
-) -> Optional[df.PETScKrylovSolver]:
+) -> LinearSolver:
     if use_krylov_solver:
+        # Use PETSc's own AMG if PETSc is built without hypre
+        pc_type = "hypre"
+        if not df.has_krylov_solver_preconditioner("hypre_amg"):
+            pc_type = "gamg"
         try:
             return solve_krylov(
                 a,
@@ -926,10 +980,9 @@ def solve_system(
                 ksp_rtol=krylov_solver_rtol,
                 ksp_max_it=krylov_solver_max_its,
                 verbose=verbose,
+                pc_type=pc_type,
             )
         except Exception:
             df.info("Failed to solve using Krylov solver. Try a regular solve...")
-            solve_regular(a, L, bcs, u, solver_parameters)
-            return None
-    solve_regular(a, L, bcs, u, solver_parameters)
-    return None
+            return solve_regular(a, L, bcs, u, solver_parameters)
+    return solve_regular(a, L, bcs, u, solver_parameters)
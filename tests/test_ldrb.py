@@ -1,3 +1,4 @@
+import dolfin as df
 import numpy as np
 import pytest
 
@@ -22,8 +23,36 @@ def test_axis():
     assert np.dot(e0, e2) == 0
 
 
+def rotation_z(a):
+    return np.array(
+        [
+            [np.cos(a), -np.sin(a), 0],
+            [np.sin(a), np.cos(a), 0],
+            [0, 0, 1],
+        ],
+    )
+
+
+def rotation_x(b):
+    return np.array(
+        [
+            [1, 0, 0],
+            [0, np.cos(b), -np.sin(b)],
+            [0, np.sin(b), np.cos(b)],
+        ],
+    )
+
+
 def test_orient():
-    pass
+    Q = ldrb.calculus.axis(np.array([1.0, 2.0, 0.5]), np.array([0.0, 1.0, -1.0]))
+
+    for alpha, beta in [(0, 0), (60, 0), (0, 30), (-40, 65), (90, -90)]:
+        a = np.radians(alpha)
+        b = np.radians(beta)
+        # The fiber angle rotates about the third axis and the sheet
+        # angle about the (rotated) first axis, in the negative direction
+        expected = Q @ rotation_z(a) @ rotation_x(-b)
+        assert np.allclose(ldrb.calculus.orient(Q, alpha, beta), expected)
 
 
 def test_bislerp():
@@ -49,13 +78,256 @@ def test_bislerp():
     Qab = ldrb.calculus.bislerp(Qa, Qb, t)
     expected = np.array(
         [
-            [-0.04821969, -0.68803995, 0.72406898],
-            [-0.5103059, 0.64013349, 0.57429697],
-            [-0.85864006, -0.34180425, -0.38197788],
+            [0.04510129, -0.68529013, 0.72687228],
+            [-0.52014838, 0.60509228, 0.60275119],
+            [-0.85288424, -0.4052663, -0.32916211],
         ],
     )
     assert np.isclose(Qab, expected).all()
 
+    # The end points are Qb and Qa with two of its axes flipped
+    assert np.allclose(ldrb.calculus.bislerp(Qa, Qb, 1.0), Qb)
+    R = Qa.T @ ldrb.calculus.bislerp(Qa, Qb, 0.0)
+    assert np.allclose(R, np.diag([-1, 1, -1]))
+
+
+def test_bislerp_interpolates_rotation():
+    Qa = rotation_z(0.1)
+    Qb = rotation_z(0.5)
+    for t in [0.0, 0.25, 0.5, 1.0]:
+        Qab = ldrb.calculus.bislerp(Qa, Qb, t)
+        assert np.allclose(Qab, rotation_z(0.1 + 0.4 * t))
+
+    # Flipping the sign of two columns of Qa describes the same
+    # coordinate system up to orientation of the axes
+    Qa_flipped = Qa @ np.diag([-1.0, -1.0, 1.0])
+    assert np.allclose(
+        ldrb.calculus.bislerp(Qa_flipped, Qb, 0.5),
+        rotation_z(0.3),
+    )
+
+
+def test_bislerp_axis_flips():
+    # A generic system, which does not commute with the flips
+    Qa = ldrb.calculus.axis(np.array([1.0, 2.0, 0.5]), np.array([0.3, -1.0, 2.0]))
+    for flip in [[1.0, -1.0, -1.0], [-1.0, 1.0, -1.0], [-1.0, -1.0, 1.0]]:
+        D = np.diag(flip)
+        # Flipping the sign of two axes gives the same coordinate system
+        for t in [0.0, 0.3, 1.0]:
+            assert np.allclose(ldrb.calculus.bislerp(Qa, Qa @ D, t), Qa @ D)
+
+        # and the interpolation is done from the closest of the flipped systems
+        Qb = Qa @ rotation_z(0.4)
+        for t in [0.0, 0.3, 1.0]:
+            assert np.allclose(
+                ldrb.calculus.bislerp(Qa @ D, Qb, t),
+                Qa @ rotation_z(0.4 * t),
+            )
+
+
+def random_rotations(n, seed=1):
+    rng = np.random.default_rng(seed)
+    u = rng.standard_normal((n, 3))
+    v = rng.standard_normal((n, 3))
+    return ldrb.calculus.axis_batched(u, v)
+
+
+def test_slerp_batched():
+    rng = np.random.default_rng(8)
+    qa = rng.standard_normal((4, 20))
+    qb = rng.standard_normal((4, 20))
+    qa /= np.linalg.norm(qa, axis=0)
+    qb /= np.linalg.norm(qb, axis=0)
+    # Close quaternions take the linear interpolation
+    qb[:, 0] = qa[:, 0]
+    t = rng.random(20)
+
+    q = ldrb.calculus.slerp_batched(qa, qb, t)
+
+    for i in range(len(t)):
+        assert np.allclose(q[:, i], ldrb.calculus.slerp(qa[:, i], qb[:, i], t[i]))
+
+
+def test_bislerp_batched():
+    n = 20
+    Qa = random_rotations(n, seed=5)
+    Qb = random_rotations(n, seed=6)
+    t = np.random.default_rng(7).random(n)
+    Qa[0] = 0
+    Qb[1] = 0
+    Qa[2] = Qb[2] = 0
+    Qa[3] = Qb[3]
+
+    Qab = ldrb.calculus.bislerp_batched(Qa, Qb, t)
+
+    for i in range(n):
+        assert np.allclose(Qab[i], ldrb.calculus.bislerp(Qa[i], Qb[i], t[i]))
+
+
+def test_bislerp_batched_axis_flips():
+    n = 30
+    Qa = random_rotations(n, seed=9)
+    D = np.array([np.diag([1, -1, -1]), np.diag([-1, 1, -1]), np.diag([-1, -1, 1])])
+    flips = D[np.arange(n) % 3]
+    t = np.random.default_rng(10).random(n)
+
+    # Flipping the sign of two axes gives the same coordinate system
+    Qb = Qa @ flips
+    assert np.allclose(ldrb.calculus.bislerp_batched(Qa, Qb, t), Qb)
+
+    # and the interpolation is done from the closest of the flipped systems
+    Qb = Qa @ rotation_z(0.4)
+    expected = np.array([Qa[i] @ rotation_z(0.4 * t[i]) for i in range(n)])
+    assert np.allclose(ldrb.calculus.bislerp_batched(Qa @ flips, Qb, t), expected)
+
+
+def test_axis_batched():
+    rng = np.random.default_rng(1)
+    u = rng.standard_normal((20, 3))
+    v = rng.standard_normal((20, 3))
+    Q = ldrb.calculus.axis_batched(u, v)
+
+    for i in range(len(u)):
+        assert np.allclose(Q[i], ldrb.calculus.axis(u[i], v[i]))
+    assert np.allclose(Q @ Q.transpose(0, 2, 1), np.eye(3))
+    assert np.allclose(np.linalg.det(Q), 1.0)
+
+
+def test_orient_batched():
+    rng = np.random.default_rng(2)
+    Q = random_rotations(20)
+    alpha = rng.uniform(-90, 90, 20)
+    beta = rng.uniform(-90, 90, 20)
+    C = ldrb.calculus.orient_batched(Q, alpha, beta)
+
+    for i in range(len(Q)):
+        assert np.allclose(C[i], ldrb.calculus.orient(Q[i], alpha[i], beta[i]))
+
+
+def test_quaternion_conversions():
+    Q = random_rotations(50)
+    # Make sure all four branches of the conversion are covered
+    Q[1] = np.diag([1.0, -1.0, -1.0])
+    Q[2] = np.diag([-1.0, 1.0, -1.0])
+    Q[3] = np.diag([-1.0, -1.0, 1.0])
+
+    q = ldrb.calculus.rotation_matrix_to_quaternion_batched(Q)
+    assert np.allclose(np.linalg.norm(q, axis=0), 1.0)
+    assert np.allclose(ldrb.calculus.quaternion_to_rotation_matrix_batched(q), Q)
+    # The conversion back should not depend on the scaling
+    assert np.allclose(ldrb.calculus.quaternion_to_rotation_matrix_batched(2 * q), Q)
+
+    for i in range(len(Q)):
+        qi = ldrb.calculus.rotation_matrix_to_quaternion(Q[i])
+        assert np.allclose(qi, q[:, i])
+        assert np.allclose(ldrb.calculus.quaternion_to_rotation_matrix(qi), Q[i])
+
+
+def random_system_data(n, seed=1):
+    rng = np.random.default_rng(seed)
+    data = {
+        "lv_scalar": rng.random(n),
+        "rv_scalar": rng.random(n) * (rng.random(n) > 0.5),
+        "epi_scalar": rng.random(n),
+        "lv_rv_scalar": np.clip(1.4 * rng.random(n) - 0.2, 0, 1),
+    }
+    for case in ["lv", "rv", "epi", "apex"]:
+        data[case + "_gradient"] = rng.standard_normal(3 * n)
+    return data
+
+
+biv_angles = dict(
+    alpha_endo_lv=60,
+    alpha_epi_lv=-60,
+    alpha_endo_rv=80,
+    alpha_epi_rv=-30,
+    alpha_endo_sept=50,
+    alpha_epi_sept=-40,
+    beta_endo_lv=-65,
+    beta_epi_lv=25,
+    beta_endo_rv=-20,
+    beta_epi_rv=10,
+    beta_endo_sept=5,
+    beta_epi_sept=-5,
+)
+
+
+def test_system_at_dofs():
+    n = 50
+    rng = np.random.default_rng(3)
+    lv = rng.random(n)
+    rv = rng.random(n) * (rng.random(n) > 0.5)
+    epi = rng.random(n)
+    grads = [rng.standard_normal((n, 3)) for _ in range(4)]
+    angles = [rng.uniform(-90, 90, n) for _ in range(4)]
+
+    Q = ldrb.calculus.system_at_dofs(lv, rv, epi, *grads, *angles, tol=0.1)
+
+    for i in range(n):
+        Qi = ldrb.calculus.system_at_dof(
+            lv[i],
+            rv[i],
+            epi[i],
+            *(g[i].copy() for g in grads),
+            *(a[i] for a in angles),
+            tol=0.1,
+        )
+        assert np.allclose(Q[i], Qi)
+
+
+def test_compute_fiber_sheet_system_permuted_dofs():
+    n = 40
+    data = random_system_data(n)
+    marker = np.zeros(n)
+    system = ldrb.ldrb.compute_fiber_sheet_system(
+        marker_scalar=marker,
+        **data,
+        **biv_angles,
+    )
+
+    # Store dof i at position perm[i]
+    perm = np.random.default_rng(4).permutation(n)
+    vector_perm = (3 * perm[:, np.newaxis] + np.arange(3)).ravel()
+    permuted_data = {}
+    for key, value in data.items():
+        permuted = np.zeros_like(value)
+        if key.endswith("_gradient"):
+            permuted[vector_perm] = value
+        else:
+            permuted[perm] = value
+        permuted_data[key] = permuted
+
+    dofs = ldrb.ldrb.Dofs(
+        vector=3 * perm[:, np.newaxis] + np.arange(3),
+        scalar=perm,
+    )
+    permuted_marker = np.zeros(n)
+    permuted_system = ldrb.ldrb.compute_fiber_sheet_system(
+        dofs=dofs,
+        marker_scalar=permuted_marker,
+        **permuted_data,
+        **biv_angles,
+    )
+
+    assert np.all(permuted_marker[perm] == marker)
+    for values, permuted_values in zip(system, permuted_system):
+        assert np.allclose(permuted_values[vector_perm], values)
+
+
+def test_compute_fiber_sheet_system_integer_scalars():
+    data = random_system_data(5)
+    data["lv_scalar"] = np.array([1, 0, 1, 1, 0])
+    data["rv_scalar"] = np.array([0, 1, 0, 0, 1])
+
+    int_system = ldrb.ldrb.compute_fiber_sheet_system(**data, **biv_angles)
+
+    data["lv_scalar"] = data["lv_scalar"].astype(float)
+    data["rv_scalar"] = data["rv_scalar"].astype(float)
+    float_system = ldrb.ldrb.compute_fiber_sheet_system(**data, **biv_angles)
+
+    for a, b in zip(int_system, float_system):
+        assert np.allclose(a, b)
+
 
 @pytest.fixture(scope="session")
 def biv_geometry():
@@ -90,8 +362,11 @@ def test_lv_angles_alpha():
         **data,
     )
 
-    fiber = np.array([0, 1, 0, 0, 0, 1, 0, -1, 0])
-    sheet = np.array([0, 0, -1, 0, 1, 0, 0, 0, 1])
+    # At the midwall the angle is interpolated half way
+    # between the endocardial angle and zero
+    h = np.sqrt(0.5)
+    fiber = np.array([0, 1, 0, 0, h, h, 0, -1, 0])
+    sheet = np.array([0, 0, -1, 0, h, -h, 0, 0, 1])
     sheet_normal = np.array([-1, 0, 0, -1, 0, 0, -1, 0, 0])
     assert norm(fib1.fiber - fiber) < tol
     assert norm(fib1.sheet - sheet) < tol
@@ -105,14 +380,15 @@ def test_lv_angles_alpha():
         **data,
     )
 
-    fiber = np.array([0, -1, 0, 0, 0, 1, 0, 1, 0])
-    sheet = np.array([0, 0, 1, 0, 1, 0, 0, 0, -1])
+    fiber = np.array([0, -1, 0, 0, -h, h, 0, 1, 0])
+    sheet = np.array([0, 0, 1, 0, h, h, 0, 0, -1])
     assert norm(fib2.fiber - fiber) < tol
     assert norm(fib2.sheet - sheet) < tol
     assert norm(fib2.sheet_normal - sheet_normal) < tol
 
     for alpha in [60, -60, 30, 40, 50, -30, -40, -50]:
         a = np.radians(alpha)
+        m = a / 2
         fib = ldrb.ldrb.compute_fiber_sheet_system(
             alpha_endo_lv=alpha,
             alpha_epi_lv=-alpha,
@@ -121,8 +397,32 @@ def test_lv_angles_alpha():
             **data,
         )
 
-        fiber = np.array([0, np.sin(a), np.cos(a), 0, 0, 1, 0, -np.sin(a), np.cos(a)])
-        sheet = np.array([0, np.cos(a), -np.sin(a), 0, 1, 0, 0, np.cos(a), np.sin(a)])
+        fiber = np.array(
+            [
+                0,
+                np.sin(a),
+                np.cos(a),
+                0,
+                np.sin(m),
+                np.cos(m),
+                0,
+                -np.sin(a),
+                np.cos(a),
+            ],
+        )
+        sheet = np.array(
+            [
+                0,
+                np.cos(a),
+                -np.sin(a),
+                0,
+                np.cos(m),
+                -np.sin(m),
+                0,
+                np.cos(a),
+                np.sin(a),
+            ],
+        )
         assert norm(fib.fiber - fiber) < tol
         assert norm(fib.sheet - sheet) < tol
         assert norm(fib.sheet_normal - sheet_normal) < tol
@@ -143,9 +443,12 @@ def test_lv_angles_beta():
     data["apex_gradient"] = np.zeros_like(data["lv_gradient"])
     data["apex_gradient"][1::3] = 1.0
 
+    # At the midwall the angle is interpolated half way
+    # between the endocardial angle and zero
+    h = np.sqrt(0.5)
     fiber = np.array([0, 0, 1, 0, 0, 1, 0, 0, 1])
-    sheet = np.array([1, 0, 0, 0, 1, 0, -1, 0, 0])
-    sheet_normal = np.array([0, 1, 0, -1, 0, 0, 0, -1, 0])
+    sheet = np.array([1, 0, 0, h, h, 0, -1, 0, 0])
+    sheet_normal = np.array([0, 1, 0, -h, h, 0, 0, -1, 0])
 
     fib1 = ldrb.ldrb.compute_fiber_sheet_system(
         alpha_endo_lv=0,
@@ -160,8 +463,8 @@ def test_lv_angles_beta():
     assert norm(fib1.sheet_normal - sheet_normal) < tol
 
     fiber = np.array([0, 0, 1, 0, 0, 1, 0, 0, 1])
-    sheet = np.array([-1, 0, 0, 0, 1, 0, 1, 0, 0])
-    sheet_normal = np.array([0, -1, 0, -1, 0, 0, 0, 1, 0])
+    sheet = np.array([-1, 0, 0, -h, h, 0, 1, 0, 0])
+    sheet_normal = np.array([0, -1, 0, -h, -h, 0, 0, 1, 0])
 
     fib2 = ldrb.ldrb.compute_fiber_sheet_system(
         alpha_endo_lv=0, alpha_epi_lv=0, beta_endo_lv=-90, beta_epi_lv=90, **data
@@ -248,6 +551,57 @@ def test_regular_laplace(lv_geometry):
     )
 
 
+@pytest.mark.parametrize("use_krylov_solver", [True, False])
+@pytest.mark.parametrize("geometry", ["lv_geometry", "biv_geometry"])
+def test_scalar_laplacians_reuse_solver(geometry, use_krylov_solver, request):
+    geo = request.getfixturevalue(geometry)
+    solutions = ldrb.ldrb.scalar_laplacians(
+        mesh=geo.mesh,
+        markers=geo.markers,
+        ffun=geo.ffun,
+        use_krylov_solver=use_krylov_solver,
+    )
+
+    V = solutions["apex"].function_space()
+    u = df.TrialFunction(V)
+    v = df.TestFunction(V)
+    a = df.dot(df.grad(u), df.grad(v)) * df.dx
+    L = v * df.Constant(0) * df.dx
+
+    # Same solver as in scalar_laplacians, so that only the reuse differs
+    solver_parameters = {"linear_solver": "mumps"}
+    if "superlu_dist" in df.linear_solver_methods():
+        solver_parameters = {"linear_solver": "superlu_dist"}
+
+    # Each case solved from scratch should match the solutions
+    # computed with the reused solver
+    cases = [case for case in ["rv", "lv", "epi"] if case in geo.markers]
+    for case in cases:
+        bcs = [
+            df.DirichletBC(
+                V,
+                1 if what == case else 0,
+                geo.ffun,
+                geo.markers[what],
+                "topological",
+            )
+            for what in cases
+        ]
+        expected = df.Function(V)
+        ldrb.ldrb.solve_system(
+            a,
+            L,
+            bcs,
+            expected,
+            solver_parameters=solver_parameters,
+            use_krylov_solver=use_krylov_solver,
+        )
+        assert np.allclose(
+            solutions[case].vector().get_local(),
+            expected.vector().get_local(),
+        )
+
+
 if __name__ == "__main__":
     # test_axis()
     # test_lv_angles()